@@ -20,9 +20,15 @@ entities at the same level.
 
 Annotations:
   newlines: The number of newlines required before the node.
+  original_newlines: The number of newlines before the node in the original
+    source.
 """
 
-from lib2to3 import pytree
+import itertools
+import operator
+
+from lib2to3 import pygram
+from lib2to3.pgen2 import token
 
 from yapf.yapflib import py3compat
 from yapf.yapflib import pytree_utils
@@ -41,6 +47,21 @@ _PYTHON_STATEMENTS = frozenset({
     'async_stmt', 'simple_stmt'
 })
 
+# Attribute names of the annotations set by this module. They are set with
+# setattr for every first token and definition, which saves a function call
+# per write over pytree_utils.SetNodeAnnotation.
+_NEWLINES_ATTR = pytree_utils.NodeAnnotationAttribute(
+    pytree_utils.Annotation.NEWLINES)
+_ORIGINAL_NEWLINES_ATTR = pytree_utils.NodeAnnotationAttribute(
+    pytree_utils.Annotation.ORIGINAL_NEWLINES)
+
+# Bitmask of the grammar symbol numbers of _PYTHON_STATEMENTS, so that the hot
+# paths can test a node type with a shift instead of building its name.
+_PYTHON_STATEMENTS_MASK = sum(
+    1 << pygram.python_grammar.symbol2number[name]
+    for name in _PYTHON_STATEMENTS
+    if name in pygram.python_grammar.symbol2number)
+
 
 def CalculateBlankLines(tree):
   """Run the blank line calculator visitor over the tree.
@@ -50,78 +71,16 @@ def CalculateBlankLines(tree):
   Arguments:
     tree: the top-level pytree node to annotate with subtypes.
   """
-  original_blank_lines_calculator = _OriginalBlankLinesCalculator()
-  original_blank_lines_calculator.Visit(tree)
-
   blank_line_calculator = _BlankLineCalculator()
-  blank_line_calculator.Visit(tree)
-
-
-class _OriginalBlankLinesCalculator(pytree_visitor.PyTreeVisitor):
-    """ Save the original blacklines.
-
-    Computes how many blanklines there were in the original source file.
-    """
-
-    def __init__(self):
-        self._level = 0
-        self.first_tokens = []
-
-    def Visit(self, node):
-        # count the recursion depth in order to perform some final
-        # computations at the exit from the root node (i.e. when level == 0)
-        #
-        self._level += 1
-        super().Visit(node)
-        self._level -= 1
-
-        if self._level == 0: # the root node
-            self._compute_newlines()
-
-    def _compute_newlines(self):
-        leaves = sorted(self.first_tokens, key=pytree.Node.get_lineno)
-
-        prev = 1
-        for leaf in leaves:
-            offset = 0
-            if pytree_utils.NodeName(leaf) == 'COMMENT':
-                # the lineno of a comment points to the last line
-                # of that comment
-                offset = leaf.value.count('\n')
-
-            newlines = leaf.get_lineno() - prev - offset
-
-            prev = leaf.get_lineno()
-            if pytree_utils.NodeName(leaf) == 'STRING':
-                # account for multiline docstrings
-                prev += leaf.value.count('\n')
-
-            self._set_original_newlines(leaf, newlines)
-
-    # Skip INDENT, DEDENT, and NEWLINE leaves - they are never (?) the
-    # frist token in an unwrapped line.
-
-    def Visit_INDENT(self, node):
-        pass
-
-    def Visit_DEDENT(self, node):
-        pass
-
-    def Visit_NEWLINE(self, node):
-        pass
-
-    def DefaultLeafVisit(self, node):
-        if (not self.first_tokens
-            or self.first_tokens[-1].get_lineno != node.get_lineno()):
-            self.first_tokens.append(node)
-
-    def _set_original_newlines(self, node, n):
-        pytree_utils.SetNodeAnnotation(node,
-            pytree_utils.Annotation.ORIGINAL_NEWLINES, n)
+  blank_line_calculator._Walk(tree)  # pylint: disable=protected-access
 
 
 class _BlankLineCalculator(pytree_visitor.PyTreeVisitor):
-  """_BlankLineCalculator - see file-level docstring for a description."""
+  """_BlankLineCalculator - see file-level docstring for a description.
+
+  Both the required number of newlines and the number of newlines in the
+  original source are computed during a single walk over the tree.
+  """
 
   def __init__(self):
     self.class_level = 0
@@ -129,20 +88,106 @@ class _BlankLineCalculator(pytree_visitor.PyTreeVisitor):
     self.last_comment_lineno = 0
     self.last_was_decorator = False
     self.last_was_class_or_function = False
+    self.top_level_newlines = (
+        1 + style.Get('BLANK_LINES_AROUND_TOP_LEVEL_DEFINITION'))
+    # (lineno, type, value, leaf) records of the first token on each line, in
+    # the order they were visited.
+    self.first_tokens = []
+    self.first_tokens_sorted = True
+    self._stack = []
+    self._walking = False
+
+  def Visit(self, node):
+    """Annotate the tree rooted at node. See _Walk."""
+    self._Walk(node)
+
+  def _Walk(self, node):
+    """Annotate the tree rooted at node.
+
+    The tree is walked with an explicit stack of (function, node) pairs rather
+    than by recursion. Each function is called with the calculator and the
+    node. Visitor methods push the children they want visited with
+    _VisitChildren, preceded by an exit action for any work that has to happen
+    after the children. They must not call Visit: a nested walk would reset
+    the stack and compute the original newlines too early.
+
+    Arguments:
+      node: (pytree.Node) The root of the tree to visit.
+
+    Raises:
+      RuntimeError: if called while a walk is in progress.
+    """
+    if self._walking:
+      raise RuntimeError('blank line calculator walk is not re-entrant',
+                         (node,))
+    self._walking = True
+    try:
+      stack = self._stack = [(_DISPATCH[node.type], node)]
+      while stack:
+        function, node = stack.pop()
+        function(self, node)
+    finally:
+      self._walking = False
+    self._ComputeOriginalNewlines()
+
+  def _VisitChildren(self, children, start=0):
+    """Schedule children[start:] to be visited in order."""
+    # The visitor for each child is resolved here, in one pass over the
+    # siblings, rather than when the child is popped off the stack.
+    dispatch = _DISPATCH
+    if start:
+      # Avoid copying the tail of the children list.
+      children = itertools.islice(reversed(children), len(children) - start)
+    else:
+      children = reversed(children)
+    self._stack.extend((dispatch[child.type], child) for child in children)
+
+  # Skip INDENT, DEDENT, and NEWLINE leaves - they are never (?) the
+  # first token in an unwrapped line.
+
+  def Visit_INDENT(self, node):  # pylint: disable=invalid-name
+    pass
+
+  def Visit_DEDENT(self, node):  # pylint: disable=invalid-name
+    pass
+
+  def Visit_NEWLINE(self, node):  # pylint: disable=invalid-name
+    pass
+
+  def DefaultLeafVisit(self, leaf):
+    lineno = leaf.lineno
+    if self.first_tokens:
+      prev_lineno = self.first_tokens[-1][0]
+      if prev_lineno == lineno and leaf.type != token.STRING:
+        # Only the first token on a line is needed, but strings are kept
+        # because they may span several lines.
+        return
+      if prev_lineno > lineno:
+        # The comment splicer may move comments after the nodes that follow
+        # them in the source (e.g. a comment before an "else" clause).
+        self.first_tokens_sorted = False
+    self.first_tokens.append((lineno, leaf.type, leaf.value, leaf))
 
   def Visit_simple_stmt(self, node):  # pylint: disable=invalid-name
+    self._stack.append((_BlankLineCalculator._LeaveSimpleStmt, node))
     self.DefaultNodeVisit(node)
-    if pytree_utils.NodeName(node.children[0]) == 'COMMENT':
-      self.last_comment_lineno = node.children[0].lineno
+
+  def _LeaveSimpleStmt(self, node):
+    first_child = node.children[0]
+    if first_child.type == token.COMMENT:
+      self.last_comment_lineno = first_child.lineno
 
   def Visit_decorator(self, node):  # pylint: disable=invalid-name
+    children = node.children
     if (self.last_comment_lineno and
-        self.last_comment_lineno == node.children[0].lineno - 1):
-      self._SetNumNewlines(node.children[0], _NO_BLANK_LINES)
+        self.last_comment_lineno == children[0].lineno - 1):
+      self._SetNumNewlines(children[0], _NO_BLANK_LINES)
     else:
-      self._SetNumNewlines(node.children[0], self._GetNumNewlines(node))
-    for child in node.children:
-      self.Visit(child)
+      self._SetNumNewlines(children[0], self._GetNumNewlines(node))
+    self._stack.append((_BlankLineCalculator._LeaveDecorator, node))
+    self._VisitChildren(children)
+
+  def _LeaveDecorator(self, node):
     self.last_was_decorator = True
 
   def Visit_classdef(self, node):  # pylint: disable=invalid-name
@@ -150,24 +195,28 @@ class _BlankLineCalculator(pytree_visitor.PyTreeVisitor):
     index = self._SetBlankLinesBetweenCommentAndClassFunc(node)
     self.last_was_decorator = False
     self.class_level += 1
-    for child in node.children[index:]:
-      self.Visit(child)
+    self._stack.append((_BlankLineCalculator._LeaveClassdef, node))
+    self._VisitChildren(node.children, index)
+
+  def _LeaveClassdef(self, node):
     self.class_level -= 1
     self.last_was_class_or_function = True
 
   def Visit_funcdef(self, node):  # pylint: disable=invalid-name
     self.last_was_class_or_function = False
-    index = self._SetBlankLinesBetweenCommentAndClassFunc(node)
     if _AsyncFunction(node):
+      # The blank lines go before the "async" keyword. The "def" keyword never
+      # gets a newlines annotation, so there is nothing to reset on it.
       index = self._SetBlankLinesBetweenCommentAndClassFunc(
           node.prev_sibling.parent)
-      self._SetNumNewlines(node.children[0], None)
     else:
       index = self._SetBlankLinesBetweenCommentAndClassFunc(node)
     self.last_was_decorator = False
     self.function_level += 1
-    for child in node.children[index:]:
-      self.Visit(child)
+    self._stack.append((_BlankLineCalculator._LeaveFuncdef, node))
+    self._VisitChildren(node.children, index)
+
+  def _LeaveFuncdef(self, node):
     self.function_level -= 1
     self.last_was_class_or_function = True
 
@@ -181,11 +230,11 @@ class _BlankLineCalculator(pytree_visitor.PyTreeVisitor):
       node: (pytree.Node) The node to visit.
     """
     if self.last_was_class_or_function:
-      if pytree_utils.NodeName(node) in _PYTHON_STATEMENTS:
+      self.last_was_class_or_function = False
+      if (_PYTHON_STATEMENTS_MASK >> node.type) & 1:
         leaf = pytree_utils.FirstLeafNode(node)
         self._SetNumNewlines(leaf, self._GetNumNewlines(leaf))
-    self.last_was_class_or_function = False
-    super(_BlankLineCalculator, self).DefaultNodeVisit(node)
+    self._VisitChildren(node.children)
 
   def _SetBlankLinesBetweenCommentAndClassFunc(self, node):
     """Set the number of blanks between a comment and class or func definition.
@@ -199,53 +248,115 @@ class _BlankLineCalculator(pytree_visitor.PyTreeVisitor):
     Returns:
       The index of the first child past the comment nodes.
     """
+    children = node.children
     index = 0
-    while pytree_utils.IsCommentStatement(node.children[index]):
+    comment = None
+    while pytree_utils.IsCommentStatement(children[index]):
       # Standalone comments are wrapped in a simple_stmt node with the comment
       # node as its only child.
-      self.Visit(node.children[index].children[0])
+      comment = children[index].children[0]
+      self.DefaultLeafVisit(comment)
       if not self.last_was_decorator:
-        self._SetNumNewlines(node.children[index].children[0], _ONE_BLANK_LINE)
+        self._SetNumNewlines(comment, _ONE_BLANK_LINE)
       index += 1
-    if (index and node.children[index].lineno -
-        1 == node.children[index - 1].children[0].lineno):
-      self._SetNumNewlines(node.children[index], _NO_BLANK_LINES)
+    first = children[index]
+    if comment is not None and first.lineno - 1 == comment.lineno:
+      self._SetNumNewlines(first, _NO_BLANK_LINES)
     else:
-      if self.last_comment_lineno + 1 == node.children[index].lineno:
+      if self.last_comment_lineno + 1 == first.lineno:
         num_newlines = _NO_BLANK_LINES
       else:
         num_newlines = self._GetNumNewlines(node)
-      self._SetNumNewlines(node.children[index], num_newlines)
+      self._SetNumNewlines(first, num_newlines)
     return index
 
   def _GetNumNewlines(self, node):
     if self.last_was_decorator:
       return _NO_BLANK_LINES
     elif self._IsTopLevel(node):
-      return 1 + style.Get('BLANK_LINES_AROUND_TOP_LEVEL_DEFINITION')
+      return self.top_level_newlines
     return _ONE_BLANK_LINE
 
   def _SetNumNewlines(self, node, num_newlines):
-    pytree_utils.SetNodeAnnotation(node, pytree_utils.Annotation.NEWLINES,
-                                   num_newlines)
+    setattr(node, _NEWLINES_ATTR, num_newlines)
+
+  def _ComputeOriginalNewlines(self):
+    """Annotate first tokens with the newlines found in the original source."""
+    # Leaves are visited in source order except for a few spliced comments, so
+    # only sort when one of those was seen.
+    records = self.first_tokens
+    if not self.first_tokens_sorted:
+      records = sorted(records, key=operator.itemgetter(0))
+
+    # Bind everything the loop needs to locals: it runs once per line of the
+    # file, so global and attribute lookups add up.
+    comment_type = token.COMMENT
+    string_type = token.STRING
+    original_newlines_attr = _ORIGINAL_NEWLINES_ATTR
+
+    prev = 1
+    prev_lineno = 0
+    for lineno, leaf_type, value, leaf in records:
+      newlines = lineno - prev
+      prev = lineno
+      # Only comments and strings can contain newlines, and most of them fit on
+      # one line, so check for a newline before counting.
+      if leaf_type == comment_type:
+        if '\n' in value:
+          # The lineno of a comment points to the last line of that comment.
+          newlines -= value.count('\n')
+      elif leaf_type == string_type:
+        if '\n' in value:
+          # Account for multiline docstrings.
+          prev += value.count('\n')
+
+      # Strings that don't start a line are only kept to track the line
+      # count. Nothing reads their original newlines.
+      if lineno != prev_lineno:
+        setattr(leaf, original_newlines_attr, newlines)
+      prev_lineno = lineno
 
   def _IsTopLevel(self, node):
-    # This is added for the sole reason to keep the original behaviour,
-    # when comments placed on their own line always had column=0.
-    # We store the actual column value now in order to support the
-    # SAVE_INITIAL_INDENTS_FORMATTING option.
-    #
-    def first_leaf_is_comment(node):
-        first_leaf = pytree_utils.FirstLeafNode(node)
-        return pytree_utils.NodeName(first_leaf) == 'COMMENT'
-
-    return (not (self.class_level or self.function_level) and
-            (_StartsInZerothColumn(node) or first_leaf_is_comment(node)))
-
-
-def _StartsInZerothColumn(node):
-  return (pytree_utils.FirstLeafNode(node).column == 0 or
-          (_AsyncFunction(node) and node.prev_sibling.column == 0))
+    if self.class_level or self.function_level:
+      return False
+    first_leaf = pytree_utils.FirstLeafNode(node)
+    # Comments placed on their own line used to always have column=0. Their
+    # actual column is stored now in order to support the
+    # SAVE_INITIAL_INDENTS_FORMATTING option, so treat them as top-level to
+    # keep the original behaviour.
+    return (first_leaf.column == 0 or first_leaf.type == token.COMMENT or
+            (_AsyncFunction(node) and node.prev_sibling.column == 0))
+
+
+def _NodeType(name):
+  """Return the token or grammar symbol number for a node name."""
+  if name in pygram.python_grammar.symbol2number:
+    return pygram.python_grammar.symbol2number[name]
+  return getattr(token, name)
+
+
+def _DispatchTable(cls):
+  """Build the table of functions that visit each node type.
+
+  Arguments:
+    cls: the visitor class.
+
+  Returns:
+    A list indexed by node type, holding the cls function that visits nodes of
+    that type. Values < 256 are tokens, i.e. leaves.
+  """
+  num_types = max(pygram.python_grammar.number2symbol) + 1
+  table = ([cls.DefaultLeafVisit] * 256 +
+           [cls.DefaultNodeVisit] * (num_types - 256))
+  for name in dir(cls):
+    if name.startswith('Visit_'):
+      table[_NodeType(name[len('Visit_'):])] = getattr(cls, name)
+  return table
+
+
+# Built once, so that dispatch doesn't need to build a method name and look it
+# up for every node, nor bind every visitor method for every file.
+_DISPATCH = _DispatchTable(_BlankLineCalculator)
 
 
 def _AsyncFunction(node):
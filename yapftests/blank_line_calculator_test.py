@@ -13,9 +13,13 @@
 # limitations under the License.
 """Tests for yapf.blank_line_calculator."""
 
+import sys
 import textwrap
 import unittest
 
+from yapf.yapflib import blank_line_calculator
+from yapf.yapflib import comment_splicer
+from yapf.yapflib import pytree_utils
 from yapf.yapflib import reformatter
 from yapf.yapflib import style
 from yapf.yapflib import yapf_api
@@ -418,5 +422,98 @@ class BasicBlankLineCalculatorTest(yapf_test_helper.YAPFTest):
     self.assertTrue(changed)
 
 
+class AnnotationsTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    style.SetGlobalStyle(style.CreateChromiumStyle())
+
+  def _CalculateBlankLines(self, code, annotation):
+    """Return (value, annotation value) pairs for the leaves of the code."""
+    tree = pytree_utils.ParseCodeToTree(code)
+    comment_splicer.SpliceComments(tree)
+    blank_line_calculator.CalculateBlankLines(tree)
+    return [(leaf.value, pytree_utils.GetNodeAnnotation(leaf, annotation))
+            for leaf in tree.leaves()
+            if leaf.value.strip()]
+
+  def testOriginalNewlines(self):
+    code = textwrap.dedent("""\
+        import os
+
+
+        x = 1  # trailing
+        \"\"\"Doc
+        string.\"\"\"
+        y = 'y'
+        # first
+        # second
+        z = 3
+        """)
+    annotations = self._CalculateBlankLines(
+        code, pytree_utils.Annotation.ORIGINAL_NEWLINES)
+    self.assertEqual([
+        ('import', 0),
+        ('os', None),
+        ('x', 3),
+        ('=', None),
+        ('1', None),
+        ('# trailing', None),
+        ('\"\"\"Doc\nstring.\"\"\"', 1),
+        ('y', 1),
+        ('=', None),
+        ("'y'", None),
+        ('# first\n# second', 1),
+        ('z', 1),
+        ('=', None),
+        ('3', None),
+    ], annotations)
+
+  def testNewlinesInNestedDefinitions(self):
+    code = textwrap.dedent("""\
+        import os
+        class A(object):
+          @property
+          def b(self):
+            def c():
+              pass
+            return c
+          class D(object):
+            pass
+          e = 1
+        # comment
+        @decorator
+        def f():
+          pass
+        g = 2
+        """)
+    annotations = self._CalculateBlankLines(code,
+                                            pytree_utils.Annotation.NEWLINES)
+    self.assertEqual([
+        ('class', 3),
+        ('@', 2),
+        ('def', 1),
+        ('def', 2),
+        ('return', 2),
+        ('class', 2),
+        ('e', 2),
+        ('# comment', 3),
+        ('@', 1),
+        ('def', 1),
+        ('g', 3),
+    ], [(value, newlines) for value, newlines in annotations if newlines])
+
+  def testDeeplyNestedTree(self):
+    depth = sys.getrecursionlimit()
+    code = 'x = ' + '(' * depth + '1' + ')' * depth + '\n'
+    tree = pytree_utils.ParseCodeToTree(code)
+    blank_line_calculator.CalculateBlankLines(tree)
+    first_leaf = pytree_utils.FirstLeafNode(tree)
+    self.assertEqual(
+        0,
+        pytree_utils.GetNodeAnnotation(
+            first_leaf, pytree_utils.Annotation.ORIGINAL_NEWLINES))
+
+
 if __name__ == '__main__':
   unittest.main()
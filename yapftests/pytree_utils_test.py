@@ -200,6 +200,23 @@ class AnnotationsTest(unittest.TestCase):
     pytree_utils.SetNodeAnnotation(self._node, _FOO, 20)
     self.assertEqual(pytree_utils.GetNodeAnnotation(self._node, _FOO), 20)
 
+  def testSetThroughAttribute(self):
+    setattr(self._leaf, pytree_utils.NodeAnnotationAttribute(_FOO), 20)
+    self.assertEqual(pytree_utils.GetNodeAnnotation(self._leaf, _FOO), 20)
+
+
+class IsCommentStatementTest(unittest.TestCase):
+
+  def testCommentStatement(self):
+    comment = pytree.Leaf(token.COMMENT, '# comment')
+    stmt = pytree.Node(pygram.python_symbols.simple_stmt, [comment])
+    self.assertTrue(pytree_utils.IsCommentStatement(stmt))
+
+  def testNonCommentStatement(self):
+    tree = pytree_utils.ParseCodeToTree('x = 1  # comment\n')
+    self.assertFalse(pytree_utils.IsCommentStatement(tree.children[0]))
+    self.assertFalse(pytree_utils.IsCommentStatement(tree))
+
 
 if __name__ == '__main__':
   unittest.main()